@@ -10,8 +10,9 @@ selflogger.propagate = False
 
 from sqlalchemy import create_engine 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey
+from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, Index
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import OperationalError
 
 Base = declarative_base()
 
@@ -56,8 +57,41 @@ class Crossref(Base):
     def __repr__(self):
         return "<Crossref(file={0}, isym={1}, reftype={2}, ifile={3}, line={4}, col={5})>".format(self.file, self.isym, self.reftype, self.ifile, self.line, self.col)
 
+# クロスリファレンスの集約モード用
+# (file, isym)ごとにreftypeをビットマスクにまとめ、Read, Write, Address-Takenの回数を数える。
+# reftypeが"Read,Write"の場合は、ReadとWriteの両方のビットを立て、両方の回数を数える。
+REFTYPE_BITS = {"Definition": 1, "Declaration": 2, "Read": 4, "Write": 8, "Address-Taken": 16}
+REFTYPE_OTHER = 32
+
+class CrossrefSummary(Base):
+    __tablename__ = 'db_crossref_summary'
+    __table_args__ = (Index('ix_db_crossref_summary_file_isym', 'file', 'isym', unique=True),)
+
+    id = Column(Integer, primary_key=True)
+    file = Column(String)
+    isym = Column(Integer)
+    reftypes = Column(Integer)
+    reads = Column(Integer)
+    writes = Column(Integer)
+    addrs = Column(Integer)
+
+    def __repr__(self):
+        return "<CrossrefSummary(file={0}, isym={1}, reftypes={2}, reads={3}, writes={4}, addrs={5})>".format(self.file, self.isym, self.reftypes, self.reads, self.writes, self.addrs)
+
+# 集計テーブル(close時に1パスで作成する)
+# bss/data/rodataの各Viewを、ファイル×セクション、セクション単位で集計し、サイズの大きいシンボルの上位N件を保持する。
+AGG_FILE_SECT = "agg_file_sect"
+AGG_SECT = "agg_sect"
+AGG_TOP_SYMBOL = "agg_top_symbol"
+AGG_VIEWS = ["bss", "data", "rodata"]
+
+# シンボル名・ファイルパス検索用のテーブル(close時に作成する)
+# SQLiteのFTS5(trigram)が使えればそれを、使えなければ通常のテーブル+インデックスを使う。
+SEARCH = "db_search"
+SEARCH_FIELDS = ("name", "file", "sect", "addr", "size", "origin")
+
 class Database:
-    def __init__(self, db_fname, echo=False, logger=None):
+    def __init__(self, db_fname, echo=False, logger=None, aggregate=False, search_index=False, crossref_summary=False, crossref_detail=None):
         self.db_fname = db_fname
         self.engine = None
         self.session = None
@@ -72,6 +106,19 @@ class Database:
         self.crossrefs = []
         self.CROSSREF_COMMIT_LEN = 20000
 
+        # dlafile.parse_blocks用(dictではなくタプルのリストを受け取る)
+        self.symbol_rows = []
+        self.crossref_rows = []
+
+        # 集約モード。crossref_detailを指定しない場合、集約モードでは1件ごとの行(db_crossref)は保存しない
+        self.crossref_summary = crossref_summary
+        self.crossref_detail = (not crossref_summary) if crossref_detail is None else crossref_detail
+        self.summaries = {}
+
+        self.aggregate = aggregate
+        self.AGG_TOP_N = 100
+
+        self.search_index = search_index
 
         self.init(echo=echo)
 
@@ -83,6 +130,11 @@ class Database:
         self.engine.execute(f"DROP TABLE IF EXISTS {Map.__tablename__}")
         self.engine.execute(f"DROP TABLE IF EXISTS {Symbol.__tablename__}")
         self.engine.execute(f"DROP TABLE IF EXISTS {Crossref.__tablename__}")
+        self.engine.execute(f"DROP TABLE IF EXISTS {CrossrefSummary.__tablename__}")
+        self.engine.execute(f"DROP TABLE IF EXISTS {AGG_FILE_SECT}")
+        self.engine.execute(f"DROP TABLE IF EXISTS {AGG_SECT}")
+        self.engine.execute(f"DROP TABLE IF EXISTS {AGG_TOP_SYMBOL}")
+        self.engine.execute(f"DROP TABLE IF EXISTS {SEARCH}")
 
         # テーブル作成
         Base.metadata.create_all(self.engine)
@@ -107,6 +159,9 @@ class Database:
                 self.maps = []
                 self.symbols = []
                 self.crossrefs = []
+                self.symbol_rows = []
+                self.crossref_rows = []
+                self.summaries = {}
                 self.log.debug("ignored. session already opened.")
             else:
                 self.session = sessionmaker(bind=self.engine)()
@@ -121,10 +176,19 @@ class Database:
             self.maps=[]
             self.symbols=[]
             self.crossrefs=[]
+            self.symbol_rows=[]
+            self.crossref_rows=[]
+            self.summaries={}
 
             self.session.close()
             self.session = None
 
+            if self.aggregate:
+                self.build_aggregates()
+
+            if self.search_index:
+                self.build_search_index()
+
             self.log.info("session closed.")
         else:
             self.log.debug("ignored. already closed")
@@ -143,10 +207,47 @@ class Database:
             self.symbols = []
 
     def cb_crossref(self, item):
-        self.crossrefs.append(item)
-        if len(self.crossrefs) > self.CROSSREF_COMMIT_LEN:
-            self.commit_crossrefs()
-            self.crossrefs = []
+        if self.crossref_summary:
+            self.summarize_crossref(item["file"], item["isym"], item["reftype"])
+        if self.crossref_detail:
+            self.crossrefs.append(item)
+            if len(self.crossrefs) > self.CROSSREF_COMMIT_LEN:
+                self.commit_crossrefs()
+                self.crossrefs = []
+
+    def cb_symbol_rows(self, rows):
+        self.symbol_rows.extend(rows)
+        if len(self.symbol_rows) > self.SYMBOLS_COMMIT_LEN:
+            self.commit_symbol_rows()
+            self.symbol_rows = []
+
+    def cb_crossref_rows(self, rows):
+        if self.crossref_summary:
+            for row in rows:
+                self.summarize_crossref(row[0], row[1], row[2])
+        if self.crossref_detail:
+            self.crossref_rows.extend(rows)
+            if len(self.crossref_rows) > self.CROSSREF_COMMIT_LEN:
+                self.commit_crossref_rows()
+                self.crossref_rows = []
+
+    def summarize_crossref(self, file, isym, reftype):
+        summary = self.summaries.get((file, isym))
+        if summary is None:
+            if len(self.summaries) >= self.CROSSREF_COMMIT_LEN:
+                self.commit_crossref_summaries()
+                self.summaries = {}
+            # [reftypes, reads, writes, addrs]
+            summary = self.summaries[(file, isym)] = [0, 0, 0, 0]
+
+        for t in reftype.split(","):
+            summary[0] |= REFTYPE_BITS.get(t, REFTYPE_OTHER)
+            if t == "Read":
+                summary[1] += 1
+            elif t == "Write":
+                summary[2] += 1
+            elif t == "Address-Taken":
+                summary[3] += 1
  
     def commit_maps(self):
         if self.session:
@@ -176,17 +277,230 @@ class Database:
             self.log.debug("ignoted. already closed")
 
 
+    def commit_symbol_rows(self):
+        if self.session:
+            if self.symbol_rows:
+                # 列の並びはdlafile.SYMBOL_FIELDSと同じ
+                self.engine.execute(f"INSERT INTO {Symbol.__tablename__} (file, isym, name, addr, scope, sect) VALUES (?, ?, ?, ?, ?, ?)", self.symbol_rows)
+            self.log.info("session committed (symbol rows)")
+        else:
+            self.log.debug("ignoted. already closed")
+
+    def commit_crossref_rows(self):
+        if self.session:
+            if self.crossref_rows:
+                # 列の並びはdlafile.CROSSREF_FIELDSと同じ
+                self.engine.execute(f"INSERT INTO {Crossref.__tablename__} (file, isym, reftype, ifile, line, col) VALUES (?, ?, ?, ?, ?, ?)", self.crossref_rows)
+            self.log.info("session committed (crossref rows)")
+        else:
+            self.log.debug("ignoted. already closed")
+
+    def commit_crossref_summaries(self):
+        if self.session:
+            if self.summaries:
+                # 同じ(file, isym)が既に書き込まれていれば(同じソースファイルが複数回出てきた場合)、足し合わせる
+                rows = [(file, isym, reftypes, reads, writes, addrs) for (file, isym), (reftypes, reads, writes, addrs) in self.summaries.items()]
+                self.engine.execute(self.sql_upsert_crossref_summary, rows)
+            self.log.info("session committed (crossref summaries)")
+        else:
+            self.log.debug("ignoted. already closed")
+
+    @property
+    def sql_upsert_crossref_summary(self):
+        sql = f"""
+        INSERT INTO {CrossrefSummary.__tablename__} (file, isym, reftypes, reads, writes, addrs)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (file, isym) DO UPDATE SET
+            reftypes = reftypes | excluded.reftypes,
+            reads = reads + excluded.reads,
+            writes = writes + excluded.writes,
+            addrs = addrs + excluded.addrs
+        """
+        return sql
+
     def commit_all(self):
         if self.session:
             self.commit_maps()
             self.commit_symbols()
             self.commit_crossrefs()
+            self.commit_symbol_rows()
+            self.commit_crossref_rows()
+            self.commit_crossref_summaries()
             self.log.info("session committed")
         else:
             self.log.debug("ignoted. already closed")
     
+    def build_aggregates(self):
+        r'''
+        bss/data/rodataの各Viewを1パスで集計し、集計テーブルを作り直す。
+
+        Notes
+        -----
+        作成するテーブル
+            agg_file_sect  : (sect, file, size, count) ファイル×セクションごとの合計サイズ
+            agg_sect       : (sect, size, count) セクションごとの合計サイズ
+            agg_top_symbol : (sect, rank, file, name, size) セクションごとのサイズ上位AGG_TOP_N件
+        sectはViewの名前(bss, data, rodata)。
+        レポートやCIのサイズチェックは、Viewを全件走査せずにこれらのテーブルを引けばよい。
+        '''
+        if not self.engine:
+            self.log.warn("engine not found.")
+            return
+
+        # Symsの結合に使う列にインデックスを張る(ロード中は挿入が遅くなるので、ここで作成する)
+        if not self.crossref_summary:
+            self.engine.execute(f"CREATE INDEX IF NOT EXISTS ix_{Crossref.__tablename__}_file_isym ON {Crossref.__tablename__} (file, isym)")
+        self.engine.execute(f"CREATE INDEX IF NOT EXISTS ix_{Map.__tablename__}_addr ON {Map.__tablename__} (addr)")
+
+        self.engine.execute(f"DROP TABLE IF EXISTS {AGG_FILE_SECT}")
+        self.engine.execute(self.sql_agg_file_sect)
+        self.engine.execute(f"CREATE INDEX ix_{AGG_FILE_SECT} ON {AGG_FILE_SECT} (sect, file)")
+
+        self.engine.execute(f"DROP TABLE IF EXISTS {AGG_SECT}")
+        self.engine.execute(self.sql_agg_sect)
+        self.engine.execute(f"CREATE UNIQUE INDEX ix_{AGG_SECT} ON {AGG_SECT} (sect)")
+
+        self.engine.execute(f"DROP TABLE IF EXISTS {AGG_TOP_SYMBOL}")
+        self.engine.execute(f"CREATE TABLE {AGG_TOP_SYMBOL} (sect TEXT, rank INTEGER, file TEXT, name TEXT, size INTEGER)")
+        for view in AGG_VIEWS:
+            self.engine.execute(self.sql_agg_top_symbol(view))
+        self.engine.execute(f"CREATE INDEX ix_{AGG_TOP_SYMBOL} ON {AGG_TOP_SYMBOL} (sect, rank)")
+
+        self.log.info("aggregates built.")
+
+    @property
+    def sql_agg_file_sect(self):
+        selects = [f"SELECT '{view}' AS sect, file, SUM(size) AS size, COUNT(*) AS count FROM {view} GROUP BY file" for view in AGG_VIEWS]
+        sql = f"""
+        CREATE TABLE {AGG_FILE_SECT}
+        AS
+        {" UNION ALL ".join(selects)}
+        """
+        return sql
+
+    @property
+    def sql_agg_sect(self):
+        sql = f"""
+        CREATE TABLE {AGG_SECT}
+        AS
+        SELECT sect, SUM(size) AS size, SUM(count) AS count
+        FROM {AGG_FILE_SECT}
+        GROUP BY sect
+        """
+        return sql
+
+    def sql_agg_top_symbol(self, view):
+        sql = f"""
+        INSERT INTO {AGG_TOP_SYMBOL} (sect, rank, file, name, size)
+        SELECT '{view}', ROW_NUMBER() OVER (ORDER BY size DESC, file, name), file, name, size
+        FROM {view}
+        ORDER BY size DESC, file, name
+        LIMIT {int(self.AGG_TOP_N)}
+        """
+        return sql
+
+    def build_search_index(self):
+        r'''
+        シンボル名・ファイルパス検索用のテーブル(db_search)を作り直す。
+
+        Notes
+        -----
+        db_searchの列
+            name   : シンボル名
+            file   : 定義されているファイル(dlaファイル由来のもののみ。マップファイル由来のものはNULL)
+            sect   : セクション
+            addr   : アドレス
+            size   : サイズ(マップファイルと結合できなかったものはNULL)
+            origin : 'dla'(db_symbol由来) or 'map'(db_map由来)
+        FTS5のtrigramトークナイザが使える場合は、GLOB/LIKEの部分一致検索にもインデックスが効く。
+        使えない場合は通常のテーブルになり、前方一致検索のみインデックスが効く。
+        '''
+        if not self.engine:
+            self.log.warn("engine not found.")
+            return
+
+        self.engine.execute(f"DROP TABLE IF EXISTS {SEARCH}")
+        try:
+            self.engine.execute(f"CREATE VIRTUAL TABLE {SEARCH} USING fts5(name, file, sect, addr UNINDEXED, size UNINDEXED, origin UNINDEXED, tokenize='trigram')")
+        except OperationalError:
+            self.log.warn("fts5 trigram tokenizer not available. fallback to plain table.")
+            self.engine.execute(f"CREATE TABLE {SEARCH} (name TEXT, file TEXT, sect TEXT, addr INTEGER, size INTEGER, origin TEXT)")
+            self.engine.execute(f"CREATE INDEX ix_{SEARCH}_name ON {SEARCH} (name)")
+            self.engine.execute(f"CREATE INDEX ix_{SEARCH}_file ON {SEARCH} (file)")
+
+        self.engine.execute(self.sql_search_index)
+        self.log.info("search index built.")
+
+    @property
+    def sql_search_index(self):
+        sql = f"""
+        INSERT INTO {SEARCH} (name, file, sect, addr, size, origin)
+        SELECT s.name, s.file, s.sect, s.addr, m.size, 'dla'
+        FROM {Symbol.__tablename__} s
+        LEFT JOIN {Map.__tablename__} m ON s.addr = m.addr
+        UNION ALL
+        SELECT m.sym, NULL, m.sect, m.addr, m.size, 'map'
+        FROM {Map.__tablename__} m
+        """
+        return sql
+
+    def search(self, pattern, mode="prefix", field="name", limit=100):
+        r'''
+        シンボル名(またはファイルパス)を検索する。build_search_index()で作成したテーブルを使う。
+
+        Parameters
+        ----------
+        pattern : str
+            検索する文字列
+
+        mode : str
+            prefix    : 前方一致("Com_"なら"Com_"で始まるもの)
+            substring : 部分一致("err_buf"なら"err_buf"を含むもの)
+            glob      : GLOBパターンをそのまま使う("Com_*Tx*"など。*, ?, [...]が使える)
+            いずれも大文字・小文字を区別する。
+
+        field : str
+            検索する列。"name"(シンボル名) or "file"(ファイルパス)
+
+        limit : int
+            返す件数の上限(並び順は不定)
+
+        Returns
+        -------
+        result : list of dict
+            {"name": str, "file": str or None, "sect": str, "addr": int, "size": int or None, "origin": str}
+
+        Examples
+        --------
+        db.search("Com_")
+        db.search("uc_err_buf", mode="substring")
+        db.search("*\\Com*.c", mode="glob", field="file")
+        '''
+        if field not in ["name", "file"]:
+            raise ValueError(f"field should be 'name' or 'file': {field}")
+
+        if mode == "prefix":
+            expr = self.escape_glob(pattern) + "*"
+        elif mode == "substring":
+            expr = "*" + self.escape_glob(pattern) + "*"
+        elif mode == "glob":
+            expr = pattern
+        else:
+            raise ValueError(f"mode should be 'prefix', 'substring' or 'glob': {mode}")
+
+        sql = f"SELECT {', '.join(SEARCH_FIELDS)} FROM {SEARCH} WHERE {field} GLOB ? LIMIT ?"
+        rows = self.engine.execute(sql, (expr, int(limit)))
+        return [dict(zip(SEARCH_FIELDS, row)) for row in rows]
+
+    @staticmethod
+    def escape_glob(s):
+        # GLOBの特殊文字を[]で囲んでエスケープする
+        return "".join("[" + c + "]" if c in "*?[" else c for c in s)
+
     @property
     def sql_syms_view(self):
+        if self.crossref_summary:
+            return self.sql_syms_summary_view
         sql = f"""
         CREATE VIEW Syms
         AS
@@ -197,6 +511,21 @@ class Database:
         """
         return sql
 
+    @property
+    def sql_syms_summary_view(self):
+        # 集約モードでは、reftypesのビットごとに1行に展開してSymsと同じ形にする
+        reftypes = " UNION ALL ".join(f"SELECT {bit} AS bit, '{name}' AS reftype" for name, bit in REFTYPE_BITS.items())
+        sql = f"""
+        CREATE VIEW Syms
+        AS
+        SELECT s.file, s.name, s.addr, m.size, s.scope, s.sect, r.reftype
+        FROM {Symbol.__tablename__} s
+        INNER JOIN {CrossrefSummary.__tablename__} c ON (s.file = c.file) AND (s.isym = c.isym)
+        INNER JOIN ({reftypes}) r ON (c.reftypes & r.bit) != 0
+        INNER JOIN {Map.__tablename__} m ON s.addr = m.addr
+        """
+        return sql
+
     @property  
     def sql_bss_view(self):
         sql = f"""
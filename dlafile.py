@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*--
 
 from logging import getLogger, DEBUG, NullHandler, StreamHandler, FileHandler
+import io
+import os
 import re
+import json
 import types
 import pathlib
 import tqdm
@@ -252,89 +255,401 @@ def parse(fname, encoding="utf-8", callback_symbol=None, callback_crossref=None,
         log.error("callback_crossref should be FunctionType or Methodtype")
         return
 
+    with open(fname, "r", encoding=encoding) as f:
+        _parse_lines(tqdm.tqdm(f), callback_symbol, callback_crossref, log)
+
+
+def _next_state(state, file_section):
+    r'''
+    ファイルセクションの行(file_section)による状態遷移。parse()とparse_blocks()で共通。
+
+    Parameters
+    ----------
+    state : str
+        現在の状態(init, parsingFiles, joinSymbolsCrossRef, parseSymbols, parseCrossReferences)
+
+    file_section : str
+        ファイルセクション情報(parse_line()のfile_section_info)
+
+    Returns
+    -------
+    nxt_state : str
+        次の状態。initから"Files"でparsingFilesに遷移したときは、Cソースファイルのパスをリセットすること。
+    '''
+    if state == "init":
+        if file_section in ["Files"]:
+            return "parsingFiles"
+    elif state == "parsingFiles":
+        return "init"
+    elif state == "joinSymbolsCrossRef":
+        if file_section in ["Symbols", "Global Symbols"]:
+            return "parseSymbols"
+        elif file_section in ["Cross References"]:
+            return "parseCrossReferences"
+        elif file_section in ["Header"]:
+            return "init"
+    elif state == "parseSymbols":
+        if file_section in ["Symbols", "Global Symbols"]:
+            pass
+        elif file_section in ["Header"]:
+            return "init"
+        else:
+            return "joinSymbolsCrossRef"
+    elif state == "parseCrossReferences":
+        return "init"
+    return state
+
+
+def _parse_lines(lines, callback_symbol, callback_crossref, log):
+    r'''
+    dlaファイルの行の並び(lines)を、状態を持って1行ずつ解析する。parse()参照。
+    '''
     c_source_file_path = None
+    cur_state = nxt_state = "init"
+
+    for i, s in enumerate(lines, 1):
+        cur_state = nxt_state
+        ev = parse_line(s)
+        log.debug(f"{i}:{s} ==> ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
+
+        if ev["file_section_info"]:
+            nxt_state = _next_state(cur_state, ev["file_section_info"])
+            if nxt_state == "parsingFiles" and cur_state == "init":
+                c_source_file_path = None
+            log.info(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
+
+        elif cur_state == "parsingFiles":
+            c_source_file_path = get_c_source_file_path(ev["content_info"])
+            if c_source_file_path:
+                nxt_state = "joinSymbolsCrossRef"
+                log.info(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
+            else:
+                log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
+
+        elif cur_state in ["parseSymbols"]:
+            sym = get_variable_symbol_info(ev["content_info"])
+            if sym:
+                symdic = {"file":c_source_file_path, "name":sym["name"], "addr": sym["addr"], "isym":sym["isym"], "scope": sym["scope"], "sect": sym["sect"]}
+                callback_symbol(symdic)
+                log.info(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}, symdic={symdic}")
+            else:
+                log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
+
+        elif cur_state in ["parseCrossReferences"]:
+            cr = get_isym_reftype(ev["content_info"])
+            if cr:
+                crdic = {"file":c_source_file_path, "isym": cr["isym"], "reftype": cr["reftype"], "ifile": cr["file"], "line": cr["line"], "col": cr["col"]}
+                callback_crossref(crdic)
+                log.info(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}, crdic={crdic}")
+            else:
+                log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
+
+        else:
+            log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
+
+
+### ブロック単位の解析について
+# parse()は1行ごとにparse_line()と正規表現のsearchを呼ぶため、行数の多いCross Referencesセクションで時間がかかる。
+# parse_blocks()は、ファイルをまとまった大きさ(行の途中では切らない)で読み込み、
+# ファイルセクションの行を複数行モードの正規表現で探して、セクションとセクションの間(ブロック)ごとに
+# Symbols, Cross Referencesの内容をfinditerでまとめて取り出す。
+# 状態遷移はparse()と同じ(ファイルセクションの行でのみ状態が変わる)なので、結果もparse()と同じになる。
+# 結果はdictではなく、以下の順に値を並べたタプルのリストでコールバックする。
+###
+SYMBOL_FIELDS = ("file", "isym", "name", "addr", "scope", "sect")
+CROSSREF_FIELDS = ("file", "isym", "reftype", "ifile", "line", "col")
+
+# 複数行モードの正規表現(1件のマッチが行をまたがないので、行ごとのsearchと同じ結果になる)
+re_line_block = re.compile(r"^[^\S\n]*(?P<file_section>Actual Calls|Auxs|Cross References|Files|Frames|Global Symbols|Hash Define Hashs|Hash Defines|Header|Include References|Procs|Static Calls|Symbols|Typedefs)[^\S\n]*$", re.MULTILINE)
+re_variable_symbol_info_block = re.compile(expr_variable_symbol_info, re.MULTILINE)
+re_isym_reftype_block = re.compile(expr_isym_reftype, re.MULTILINE)
+
+def _read_chunks(f, chunk_size):
+    r'''
+    ファイルをchunk_size文字程度ずつ、行の途中で切らずに読み込むジェネレータ。
+    '''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        if not chunk.endswith("\n"):
+            chunk += f.readline()
+        yield chunk
+
+
+def _scan_blocks(chunks, callback_symbols, callback_crossrefs, log):
+    r'''
+    行の途中で切れていない文字列の並び(chunks)を、ブロック単位で解析する。parse_blocks()参照。
+    '''
+    c_source_file_path = None
+    state = "init"
+
+    for chunk in chunks:
+        pos = 0
+        for m in re_line_block.finditer(chunk):
+            c_source_file_path, state = _scan_block(chunk[pos:m.start()], c_source_file_path, state, callback_symbols, callback_crossrefs, log)
+            pos = m.end()
+
+            # ファイルセクションの行による状態遷移(parse()と共通)
+            file_section = m.group("file_section")
+            nxt_state = _next_state(state, file_section)
+            if nxt_state == "parsingFiles" and state == "init":
+                c_source_file_path = None
+            log.debug(f"file_section={file_section}, cur_state={state}, nxt_state={nxt_state}")
+            state = nxt_state
+
+        # チャンクの残りは、次のチャンクの先頭と同じブロックの続き
+        c_source_file_path, state = _scan_block(chunk[pos:], c_source_file_path, state, callback_symbols, callback_crossrefs, log)
+
+
+def _scan_block(block, c_source_file_path, state, callback_symbols, callback_crossrefs, log):
+    r'''
+    ファイルセクションの行を含まないブロックを、現在の状態に応じて解析する。
+
+    Returns
+    -------
+    (c_source_file_path, state) : tuple
+        解析後のCソースファイルのパスと状態
+    '''
+    if not block:
+        return c_source_file_path, state
+
+    if state == "parsingFiles":
+        # Filesセクションは小さいので1行ずつ見る
+        for s in block.splitlines():
+            path = get_c_source_file_path(s)
+            if path:
+                log.info(f"c_source_file_path={path}, cur_state={state}, nxt_state=joinSymbolsCrossRef")
+                return path, "joinSymbolsCrossRef"
+
+    elif state == "parseSymbols":
+        rows = [(c_source_file_path, int(m.group("isym"),16), m.group("name"), int(m.group("addr"),16), m.group("scope"), m.group("sect"))
+                for m in re_variable_symbol_info_block.finditer(block)]
+        if rows:
+            callback_symbols(rows)
+            log.info(f"file={c_source_file_path}, cur_state={state}, symbols={len(rows)}")
+
+    elif state == "parseCrossReferences":
+        rows = [(c_source_file_path, int(m.group("isym")), m.group("reftype"), m.group("file"), int(m.group("line")), int(m.group("col")))
+                for m in re_isym_reftype_block.finditer(block)]
+        if rows:
+            callback_crossrefs(rows)
+            log.info(f"file={c_source_file_path}, cur_state={state}, crossrefs={len(rows)}")
+
+    return c_source_file_path, state
+
+
+def parse_blocks(fname, encoding="utf-8", callback_symbols=None, callback_crossrefs=None, logger=selflogger, chunk_size=16*1024*1024):
+    r'''
+    テキスト化された.dlaを、セクション(ブロック)単位でまとめて解析する
+
+    Parameters
+    ----------
+    fname : str
+        テキスト化された.dlaのファイル名
+
+    callback_symbols : function or None
+        シンボル情報のリストを受け取る関数。
+        リストの要素はSYMBOL_FIELDSの順に値を並べたタプル。
+
+    callback_crossrefs : function or None
+        クロスリファレンス情報のリストを受け取る関数。
+        リストの要素はCROSSREF_FIELDSの順に値を並べたタプル。
+
+    logger : logger
+        デバッグログを出力するloggingモジュールのloggerインスタンス。
+
+    chunk_size : int
+        一度に読み込む文字数の目安。メモリ使用量はおおよそこれに比例する。
+
+    Notes
+    -----
+    解析結果はparse()と同じ。コールバックの回数が1件ごとではなくブロックごとになる。
+    1回のコールバックで受け取るのは、1つのセクションのうち1チャンクに含まれる分まで。
+
+    Examples
+    -----
+    db = database.Database("test.sqlite3")
+    db.open()
+    dlafile.parse_blocks("dla.txt", callback_symbols=db.cb_symbol_rows, callback_crossrefs=db.cb_crossref_rows)
+    db.close()
+    '''
+    # loggerを設定(デフォルトは何も出力しない)
+    log = logger or selflogger
+
+    if not callable(callback_symbols):
+        log.error("callback_symbols should be callable")
+        return
+
+    if not callable(callback_crossrefs):
+        log.error("callback_crossrefs should be callable")
+        return
+
     with open(fname, "r", encoding=encoding) as f:
-        cur_state = nxt_state = "init"
-        
-        for i, s in tqdm.tqdm(enumerate(f, 1)):
-            cur_state = nxt_state
-            ev = parse_line(s)
-            log.debug(f"{i}:{s} ==> ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-
-            if cur_state == "init":
-                if ev["file_section_info"] in ["Files"]:
-                    c_source_file_path = None
-                    nxt_state = "parsingFiles"
-                    log.info(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                else:
-                    log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                    pass
-
-            elif cur_state == "parsingFiles":
-                if ev["content_info"]:
-                    c_source_file_path = get_c_source_file_path(ev["content_info"])
-                    if c_source_file_path:
-                        nxt_state = "joinSymbolsCrossRef"
-                        log.info(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                    else:
-                        log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                        pass
-                else:
-                    nxt_state = "init"
-                    log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-
-            elif cur_state in ["joinSymbolsCrossRef"]:
-                if ev["file_section_info"] in ["Symbols", "Global Symbols"]:
-                    nxt_state = "parseSymbols"
-                    log.info(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                elif ev["file_section_info"] in ["Cross References"]:
-                    nxt_state = "parseCrossReferences"
-                    log.info(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                elif ev["file_section_info"] in ["Header"]:
-                    nxt_state = "init"
-                    log.info(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                else:
-                    log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                    pass
-
-            elif cur_state in ["parseSymbols"]:
-                if ev["content_info"]:
-                    sym = get_variable_symbol_info(ev["content_info"])
-                    if sym:
-                        symdic = {"file":c_source_file_path, "name":sym["name"], "addr": sym["addr"], "isym":sym["isym"], "scope": sym["scope"], "sect": sym["sect"]}
-                        callback_symbol(symdic)
-                        log.info(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}, symdic={symdic}")
-                    else:
-                        log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                        pass
-                elif ev["file_section_info"] in ["Symbols", "Global Symbols"]:
-                    log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                    pass
-                elif ev["file_section_info"] in ["Header"]:
-                    nxt_state = "init"
-                    log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                else:
-                    nxt_state = "joinSymbolsCrossRef"
-                    log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-
-            elif cur_state in ["parseCrossReferences"]:
-                if ev["content_info"]:
-                    cr = get_isym_reftype(ev["content_info"])
-                    if cr:
-                        crdic = {"file":c_source_file_path, "isym": cr["isym"], "reftype": cr["reftype"], "ifile": cr["file"], "line": cr["line"], "col": cr["col"]}
-                        callback_crossref(crdic)
-                        log.info(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}, crdic={crdic}")
-                    else:
-                        log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
-                else:
-                    nxt_state = "init"
-                    log.debug(f"ev={ev}, cur_state={cur_state}, nxt_state={nxt_state}")
+        _scan_blocks(tqdm.tqdm(_read_chunks(f, chunk_size)), callback_symbols, callback_crossrefs, log)
+
+
+### CUインデックスについて
+# 1つのCソースファイルの情報だけが欲しい場合でも、parse()はdlaファイル全体を読む必要がある。
+# build_index()は、コンパイル単位(CU: Headerから次のHeaderの手前まで)ごとに
+# - CUの先頭・末尾のバイトオフセット
+# - Header, Files, Symbols, Global Symbols, Cross Referencesの各行のバイトオフセット
+# - Cソースファイルのパス(c_source_file_path)
+# を記録したインデックスを、dlaファイルの横(<dlaファイル名>.cuidx.json)に保存する。
+# parse_source_file()は、インデックスから該当するCUの位置を引き、そこだけを読んで解析する。
+# Headerの行ではどの状態からも"init"に戻るので、CUだけを解析してもparse()の結果と同じになる。
+###
+INDEX_SECTIONS = ["Header", "Files", "Symbols", "Global Symbols", "Cross References"]
+re_line_bytes = re.compile(rb"^\s*(?P<file_section>Actual Calls|Auxs|Cross References|Files|Frames|Global Symbols|Hash Define Hashs|Hash Defines|Header|Include References|Procs|Static Calls|Symbols|Typedefs)\s*$")
+
+def _index_fname(fname, index_fname):
+    return index_fname or str(fname) + ".cuidx.json"
+
+
+def build_index(fname, encoding="utf-8", index_fname=None, logger=selflogger):
+    r'''
+    テキスト化された.dlaのCUインデックスを作成し、ファイルに保存する
+
+    Parameters
+    ----------
+    fname : str
+        テキスト化された.dlaのファイル名
+
+    index_fname : str or None
+        インデックスのファイル名。Noneの場合は<fname>.cuidx.json
+
+    logger : logger
+        デバッグログを出力するloggingモジュールのloggerインスタンス。
+
+    Returns
+    -------
+    index : dict
+        インデックスを保存できなかった場合も、作成したものを返す。
+        {"size": int, "mtime_ns": int, "encoding": str,
+         "cus": [{"c_source_file_path": str or None, "start": int, "end": int,
+                  "sections": {"Header": [int, ...], "Files": [int, ...], ...}}, ...]}
+        start, end, sectionsの値はバイトオフセット。endは含まない。
+    '''
+    log = logger or selflogger
+
+    cus = []
+    cu = {"c_source_file_path": None, "start": 0, "end": 0, "sections": {}}
+    in_files = False
+    pos = 0
+    with open(fname, "rb") as f:
+        for line in tqdm.tqdm(f):
+            m = re_line_bytes.match(line)
+            if m:
+                file_section = m.group("file_section").decode("ascii")
+                if file_section == "Header":
+                    # ここまでを1つのCUとする(先頭のHeaderより前に何もなければ捨てる)
+                    if cu["sections"]:
+                        cu["end"] = pos
+                        cus.append(cu)
+                    cu = {"c_source_file_path": None, "start": pos, "end": pos, "sections": {}}
+                if file_section in INDEX_SECTIONS:
+                    cu["sections"].setdefault(file_section, []).append(pos)
+                in_files = file_section == "Files"
+            elif in_files and cu["c_source_file_path"] is None:
+                cu["c_source_file_path"] = get_c_source_file_path(line.decode(encoding, errors="replace"))
+            pos += len(line)
+
+    if cu["sections"]:
+        cu["end"] = pos
+        cus.append(cu)
+
+    st = os.stat(fname)
+    index = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "encoding": encoding, "cus": cus}
+    # dlaファイルが読み取り専用のディレクトリにある場合などは保存できないが、作成したインデックスはそのまま使う
+    try:
+        with open(_index_fname(fname, index_fname), "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+    except OSError as e:
+        log.warning(f"index not saved. {e}")
+    log.info(f"index built. cus={len(cus)}")
+    return index
+
+
+def load_index(fname, encoding="utf-8", index_fname=None, logger=selflogger):
+    r'''
+    CUインデックスを読み込む。インデックスが無いか、dlaファイルが更新されている場合は作り直す。
+
+    Returns
+    -------
+    index : dict
+        build_index()参照
+    '''
+    log = logger or selflogger
+
+    st = os.stat(fname)
+    try:
+        with open(_index_fname(fname, index_fname), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        if index["size"] == st.st_size and index["mtime_ns"] == st.st_mtime_ns and index["encoding"] == encoding:
+            return index
+        log.info("index is stale. rebuild.")
+    except (OSError, ValueError, KeyError):
+        log.info("index not found. build.")
+    return build_index(fname, encoding=encoding, index_fname=index_fname, logger=log)
+
+
+def parse_source_file(fname, c_source_file_path, encoding="utf-8", callback_symbol=None, callback_crossref=None, index_fname=None, logger=selflogger):
+    r'''
+    テキスト化された.dlaのうち、指定したCソースファイルのCUだけを解析する
+
+    Parameters
+    ----------
+    fname : str
+        テキスト化された.dlaのファイル名
+
+    c_source_file_path : str
+        Cソースファイルのパス(get_c_source_file_path()が返すもの。ビルドしたフォルダをトップとする相対パス)
+
+    callback_symbol, callback_crossref, logger
+        parse()と同じ
+
+    index_fname : str or None
+        インデックスのファイル名。Noneの場合は<fname>.cuidx.json。無ければ作成する。
+
+    Returns
+    -------
+    ncu : int or None
+        解析したCUの数。コールバックが不正な場合はNone
+
+    Examples
+    -----
+    dlafile.parse_source_file("dla.txt", "root\\a\\b\\c\\d\\e.c", callback_symbol=print, callback_crossref=print)
+    '''
+    log = logger or selflogger
+
+    if not callable(callback_symbol):
+        log.error("callback_symbol should be callable")
+        return None
+
+    if not callable(callback_crossref):
+        log.error("callback_crossref should be callable")
+        return None
+
+    index = load_index(fname, encoding=encoding, index_fname=index_fname, logger=log)
+    cus = [cu for cu in index["cus"] if cu["c_source_file_path"] == c_source_file_path]
+
+    with open(fname, "rb") as f:
+        for cu in cus:
+            f.seek(cu["start"])
+            data = f.read(cu["end"] - cu["start"])
+            log.info(f"c_source_file_path={c_source_file_path}, start={cu['start']}, end={cu['end']}")
+            _parse_lines(io.TextIOWrapper(io.BytesIO(data), encoding=encoding), callback_symbol, callback_crossref, log)
+
+    return len(cus)
+
 
 if __name__ == '__main__':
     # 引数の解析
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument("file", help="解析するdlaファイル",  type=str, nargs=1)
+    parser.add_argument("--block", help="ブロック単位で解析する(parse_blocks)", action="store_true")
+    parser.add_argument("--source", help="指定したCソースファイルのCUだけを解析する(parse_source_file)", type=str, default=None)
     args = parser.parse_args()
 
     # デバッグログ出力の設定
@@ -350,5 +665,14 @@ if __name__ == '__main__':
     def crossref(item):
         print(item)
 
+    def rows(items):
+        for item in items:
+            print(item)
+
     # 解析開始
-    parse(args.file[0], callback_symbol=symbol, callback_crossref=crossref, logger=None)
+    if args.source:
+        parse_source_file(args.file[0], args.source, callback_symbol=symbol, callback_crossref=crossref, logger=None)
+    elif args.block:
+        parse_blocks(args.file[0], callback_symbols=rows, callback_crossrefs=rows, logger=None)
+    else:
+        parse(args.file[0], callback_symbol=symbol, callback_crossref=crossref, logger=None)
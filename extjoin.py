@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+from logging import getLogger, DEBUG, NullHandler, StreamHandler, FileHandler
+selflogger = getLogger(__name__)
+selflogger.setLevel(DEBUG)
+selflogger.addHandler(NullHandler()) # 必要に応じてStremaHandlerなどを設定する
+selflogger.propagate = False
+
+import os
+import gzip
+import pickle
+import heapq
+import shutil
+import tempfile
+import itertools
+
+### 外部メモリでの結合について
+# Database(SQLite)でシンボルとクロスリファレンスを(file, isym)で結合すると(Symsビュー)、
+# クロスリファレンスの件数が多いため、SQLiteの一時領域が巨大になる。
+# ExternalJoinは、dlafile.parse(またはparse_blocks)の結果を一定件数ごとにソートして
+# 圧縮したランファイルに書き出し、最後にk-wayマージしながら結合する。
+# メモリに持つレコード数はrun_lenで抑える(マップファイルの(addr, size)と、1ファイル分の結合結果を除く)。
+# 結合結果はSymsビューと同じ列(file, name, addr, size, scope, sect, reftype)で、重複は取り除く。
+###
+SYMS_FIELDS = ("file", "name", "addr", "size", "scope", "sect", "reftype")
+
+def _write_run(path, records, frame_len):
+    r'''
+    ソート済みのレコードをframe_len件ずつpickleにして、gzip圧縮したランファイルに書き出す。
+    '''
+    with gzip.open(path, "wb", compresslevel=1) as f:
+        for i in range(0, len(records), frame_len):
+            pickle.dump(records[i:i + frame_len], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_run(path):
+    r'''
+    ランファイルのレコードを先頭から順に返すジェネレータ。
+    '''
+    with gzip.open(path, "rb") as f:
+        while True:
+            try:
+                frame = pickle.load(f)
+            except EOFError:
+                break
+            yield from frame
+
+
+class ExternalJoin:
+    def __init__(self, tmpdir=None, run_len=500000, fanin=64, logger=None):
+        r'''
+        Parameters
+        ----------
+        tmpdir : str or None
+            ランファイルを置くディレクトリ。Noneの場合はtempfileの既定の場所。
+
+        run_len : int
+            メモリに持つレコード数の上限。
+            読み込み中は、シンボル、クロスリファレンスそれぞれこれを超えるとソートしてランファイルに書き出す。
+            マージ中は、開いているランファイルごとに1フレーム(RUN_FRAME_LEN件)ずつ読むので、
+            RUN_FRAME_LEN = run_len // (2 * fanin) として、2ストリーム合わせてrun_len件以内に収める。
+            ただし、マップファイルの(addr, size)と、join()で重複除去に使う1ファイル分の結果は上限に含まれない。
+
+        fanin : int
+            1回のマージで同時に開くランファイルの数の上限。
+            ランファイルがこれより多い場合は、何段かに分けてマージする。
+        '''
+        self.log = logger or selflogger
+        self.tmpdir = tempfile.mkdtemp(prefix="extjoin_", dir=tmpdir)
+
+        self.SYMBOLS_RUN_LEN = run_len
+        self.CROSSREF_RUN_LEN = run_len
+        self.MERGE_FANIN = fanin
+        # マージ時に同時に読み込むのは、2ストリーム × fanin個のランファイル × 1フレーム
+        self.RUN_FRAME_LEN = max(1, run_len // (2 * fanin))
+
+        # addr -> [size, ...] (マップファイルは小さいのでメモリに持つ)
+        self.maps = {}
+
+        # (file, isym, name, addr, scope, sect)
+        self.symbols = []
+        self.symbol_runs = []
+
+        # (file, isym, reftype) 結合に使わないline, colは捨て、重複もここで除く
+        self.crossrefs = set()
+        self.crossref_runs = []
+
+        self.nrun = 0
+
+    def close(self):
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+            self.log.info("run files removed.")
+        else:
+            self.log.debug("ignored. already closed")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # 例外やjoin()の途中終了でも、ランファイルを残さない
+        self.close()
+        return False
+
+
+    def cb_map(self, item):
+        self.maps.setdefault(item["addr"], []).append(item["size"])
+
+    def cb_symbol(self, item):
+        self.symbols.append((item["file"], item["isym"], item["name"], item["addr"], item["scope"], item["sect"]))
+        if len(self.symbols) > self.SYMBOLS_RUN_LEN:
+            self.spill_symbols()
+
+    def cb_crossref(self, item):
+        self.crossrefs.add((item["file"], item["isym"], item["reftype"]))
+        if len(self.crossrefs) > self.CROSSREF_RUN_LEN:
+            self.spill_crossrefs()
+
+    def cb_symbol_rows(self, rows):
+        # 列の並びはdlafile.SYMBOL_FIELDSと同じ
+        self.symbols.extend(rows)
+        if len(self.symbols) > self.SYMBOLS_RUN_LEN:
+            self.spill_symbols()
+
+    def cb_crossref_rows(self, rows):
+        # 列の並びはdlafile.CROSSREF_FIELDSと同じ
+        self.crossrefs.update(row[:3] for row in rows)
+        if len(self.crossrefs) > self.CROSSREF_RUN_LEN:
+            self.spill_crossrefs()
+
+
+    def _new_run_path(self):
+        self.nrun += 1
+        return os.path.join(self.tmpdir, f"run{self.nrun:06d}.pkl.gz")
+
+    def spill_symbols(self):
+        if self.symbols:
+            path = self._new_run_path()
+            self.symbols.sort()
+            _write_run(path, self.symbols, self.RUN_FRAME_LEN)
+            self.symbol_runs.append(path)
+            self.log.info(f"spilled {len(self.symbols)} symbols to {path}")
+            self.symbols = []
+
+    def spill_crossrefs(self):
+        if self.crossrefs:
+            path = self._new_run_path()
+            _write_run(path, sorted(self.crossrefs), self.RUN_FRAME_LEN)
+            self.crossref_runs.append(path)
+            self.log.info(f"spilled {len(self.crossrefs)} crossrefs to {path}")
+            self.crossrefs = set()
+
+    def _merge_runs(self, runs):
+        r'''
+        ランファイルをMERGE_FANIN個以下になるまで段階的にマージし、全体をソート順に返すイテレータを作る。
+        '''
+        while len(runs) > self.MERGE_FANIN:
+            merged = []
+            for i in range(0, len(runs), self.MERGE_FANIN):
+                group = runs[i:i + self.MERGE_FANIN]
+                path = self._new_run_path()
+                with gzip.open(path, "wb", compresslevel=1) as f:
+                    it = heapq.merge(*[_read_run(p) for p in group])
+                    while True:
+                        frame = list(itertools.islice(it, self.RUN_FRAME_LEN))
+                        if not frame:
+                            break
+                        pickle.dump(frame, f, protocol=pickle.HIGHEST_PROTOCOL)
+                for p in group:
+                    os.remove(p)
+                merged.append(path)
+                self.log.info(f"merged {len(group)} runs into {path}")
+            runs = merged
+        return runs, heapq.merge(*[_read_run(p) for p in runs])
+
+    def join(self):
+        r'''
+        シンボルとクロスリファレンスを(file, isym)で、マップファイルとaddrで結合した結果を返すジェネレータ。
+
+        Returns
+        -------
+        rows : generator of tuple
+            SYMS_FIELDSの順に値を並べたタプル。(file, name, addr, size, scope, sect, reftype)
+            Symsビューと同じ結合条件で、重複を除いたもの。fileの昇順に返す。
+
+        Notes
+        -----
+        残りのレコードをランファイルに書き出してから、シンボル、クロスリファレンスそれぞれを
+        k-wayマージし、ソートマージ結合する。
+        両方とも(file, isym)順に並んでいるので、同じfileの結果は連続して出てくる。
+        重複の除去はfileごとに行うので、メモリに持つのは1ファイル分の結果だけ。
+
+        Examples
+        --------
+        with extjoin.ExternalJoin(run_len=200000) as ej:
+            mapfile.parse("map.map", callback=ej.cb_map)
+            dlafile.parse_blocks("dla.txt", callback_symbols=ej.cb_symbol_rows, callback_crossrefs=ej.cb_crossref_rows)
+            for row in ej.join():
+                print(row)
+        '''
+        self.spill_symbols()
+        self.spill_crossrefs()
+        self.symbol_runs, symbols = self._merge_runs(self.symbol_runs)
+        self.crossref_runs, crossrefs = self._merge_runs(self.crossref_runs)
+
+        key = lambda r: (r[0], r[1])
+        sym_groups = itertools.groupby(symbols, key=key)
+        cr_groups = itertools.groupby(crossrefs, key=key)
+
+        cur_file = None
+        seen = set()
+        sym_key, sym_group = next(sym_groups, (None, None))
+        cr_key, cr_group = next(cr_groups, (None, None))
+        while sym_key is not None and cr_key is not None:
+            if sym_key < cr_key:
+                sym_key, sym_group = next(sym_groups, (None, None))
+            elif sym_key > cr_key:
+                cr_key, cr_group = next(cr_groups, (None, None))
+            else:
+                if sym_key[0] != cur_file:
+                    cur_file = sym_key[0]
+                    seen = set()
+
+                # マージ済みなので同じreftypeは連続している
+                reftypes = [reftype for reftype, _ in itertools.groupby(r[2] for r in cr_group)]
+                for file, isym, name, addr, scope, sect in sym_group:
+                    for size in self.maps.get(addr, []):
+                        for reftype in reftypes:
+                            row = (file, name, addr, size, scope, sect, reftype)
+                            if row not in seen:
+                                seen.add(row)
+                                yield row
+
+                sym_key, sym_group = next(sym_groups, (None, None))
+                cr_key, cr_group = next(cr_groups, (None, None))
+
+
+if __name__ == '__main__':
+    # 引数の解析
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("map", help="解析するマップファイル",  type=str)
+    parser.add_argument("dla", help="解析するdlaファイル",  type=str)
+    parser.add_argument("--run-len", help="メモリに溜めるレコード数の上限", type=int, default=500000)
+    parser.add_argument("--tmpdir", help="ランファイルを置くディレクトリ", type=str, default=None)
+    args = parser.parse_args()
+
+    import csv
+    import sys
+    import mapfile
+    import dlafile
+
+    with ExternalJoin(tmpdir=args.tmpdir, run_len=args.run_len) as ej:
+        mapfile.parse(args.map, callback=ej.cb_map)
+        dlafile.parse_blocks(args.dla, callback_symbols=ej.cb_symbol_rows, callback_crossrefs=ej.cb_crossref_rows)
+
+        writer = csv.writer(sys.stdout)
+        writer.writerow(SYMS_FIELDS)
+        writer.writerows(ej.join())
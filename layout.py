@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+from logging import getLogger, DEBUG, NullHandler, StreamHandler, FileHandler
+selflogger = getLogger(__name__)
+selflogger.setLevel(DEBUG)
+selflogger.addHandler(NullHandler()) # 必要に応じてStremaHandlerなどを設定する
+selflogger.propagate = False
+
+import heapq
+from collections import defaultdict
+
+### セクション配置の解析について
+# mapfile.parseが返す(sect, addr, size, sym)から、セクションごとの
+# - 使用中のアドレス範囲(隣接・重なりをまとめたもの)
+# - アライメントによる隙間(パディング)
+# - シンボル同士の重なり
+# - 空き領域(大きい順)
+# を求めます。
+# セクションごとにアドレスでソートし、1回の走査(スイープ)で求めるので、O(n log n)で済みます。
+# (SQLの自己結合で隙間を探すとO(n^2)になる)
+###
+
+def _sweep(items):
+    r'''
+    アドレス順にソート済みの(addr, end, sym)を走査し、使用範囲・隙間・重なりを返す。
+
+    Parameters
+    ----------
+    items : list of tuple
+        (addr, end, sym)のリスト。addrの昇順にソートされていること。
+
+    Returns
+    -------
+    occupied : list of tuple
+        (start, end)のリスト。隣接・重なりをまとめた使用範囲。
+    gaps : list of tuple
+        (start, end)のリスト。使用範囲の間の隙間。
+    overlaps : list of tuple
+        (start, end, sym_a, sym_b)のリスト。sym_aの範囲にsym_bが重なっている部分。
+        重なっているシンボルの組はすべて含まれる(sym_aのaddr <= sym_bのaddr)。
+    '''
+    occupied = []
+    gaps = []
+    overlaps = []
+
+    # まだ終わっていないシンボル(end, sym)を、endが小さい順に取り出せるヒープで持つ
+    # 重なりは、新しいシンボルとヒープに残っている全シンボルの組で求める(O(n log n + 重なりの数))
+    opened = []
+    cur_start = cur_end = None
+    for addr, end, sym in items:
+        while opened and opened[0][0] <= addr:
+            heapq.heappop(opened)
+        for open_end, open_sym in opened:
+            overlaps.append((addr, min(end, open_end), open_sym, sym))
+        heapq.heappush(opened, (end, sym))
+
+        if cur_end is None:
+            cur_start, cur_end = addr, end
+        elif addr > cur_end:
+            occupied.append((cur_start, cur_end))
+            gaps.append((cur_end, addr))
+            cur_start, cur_end = addr, end
+        elif end > cur_end:
+            cur_end = end
+
+    if cur_end is not None:
+        occupied.append((cur_start, cur_end))
+
+    return occupied, gaps, overlaps
+
+
+def analyze(maps, align=4, top_n=10, regions=None, logger=None):
+    r'''
+    マップファイルの解析結果から、セクションごとの配置(使用範囲、隙間、重なり、空き領域)を求める。
+
+    Parameters
+    ----------
+    maps : iterable of dict
+        mapfile.parseがコールバックするdictの並び。
+        {"sect": str, "addr": int, "size": int, "sym": str}
+
+    align : int
+        アライメント。隙間がalignより小さく、かつ次のシンボルのアドレスがalignの倍数のとき、
+        その隙間はアライメントによるパディングとみなす。
+
+    top_n : int
+        空き領域を大きい順にいくつ返すか。
+
+    regions : dict or None
+        RAM/ROMなどの領域。{"名前": (開始アドレス, 終了アドレス)} 終了アドレスは含まない。
+        指定した場合、全セクションのシンボルを合わせて、領域内の空き領域を求める。
+
+    logger : logger
+        デバッグログを出力するloggingモジュールのloggerインスタンス。
+
+    Returns
+    -------
+    result : dict
+        キー
+          sections : {セクション名: セクション情報(dict)}
+            start, end   : セクションの先頭・末尾アドレス
+            used         : 使用中のバイト数(重なりは1回だけ数える)
+            padding      : アライメントによる隙間のバイト数
+            free         : パディング以外の隙間のバイト数
+            occupied     : 使用範囲 [(start, end), ...]
+            gaps         : 隙間 [(start, end), ...]
+            overlaps     : 重なり [(start, end, sym_a, sym_b), ...]
+            free_blocks  : パディング以外の隙間の大きい順top_n件 [(start, end), ...]
+          regions : {領域名: 領域情報(dict)}  ※regionsを指定したときのみ
+            start, end, used, free, free_blocks
+
+    Examples
+    --------
+    maps = []
+    mapfile.parse("map.map", callback=maps.append)
+    result = layout.analyze(maps, align=4, regions={"RAM": (0xfee00000, 0xfee10000)})
+
+    重なりの例(cはaの内側にあり、bとも重なっている)
+    In [1]: maps = [{"sect": ".bss", "addr": 0, "size": 50, "sym": "a"},
+                    {"sect": ".bss", "addr": 10, "size": 50, "sym": "b"},
+                    {"sect": ".bss", "addr": 20, "size": 10, "sym": "c"}]
+    In [2]: layout.analyze(maps)["sections"][".bss"]["overlaps"]
+    Out[2]: [(10, 50, 'a', 'b'), (20, 30, 'a', 'c'), (20, 30, 'b', 'c')]
+    '''
+    log = logger or selflogger
+
+    # セクションごとに(addr, end, sym)のタプルにしておく(dictのままよりメモリが小さい)
+    by_sect = defaultdict(list)
+    for m in maps:
+        by_sect[m["sect"]].append((m["addr"], m["addr"] + m["size"], m["sym"]))
+
+    sections = {}
+    for sect, items in by_sect.items():
+        items.sort()
+        occupied, gaps, overlaps = _sweep(items)
+
+        padding = 0
+        free_gaps = []
+        for start, end in gaps:
+            if end - start < align and end % align == 0:
+                padding += end - start
+            else:
+                free_gaps.append((start, end))
+
+        sections[sect] = {
+            "start": occupied[0][0],
+            "end": occupied[-1][1],
+            "used": sum(end - start for start, end in occupied),
+            "padding": padding,
+            "free": sum(end - start for start, end in free_gaps),
+            "occupied": occupied,
+            "gaps": gaps,
+            "overlaps": overlaps,
+            "free_blocks": heapq.nlargest(top_n, free_gaps, key=lambda g: g[1] - g[0]),
+        }
+        log.info(f"sect={sect}, symbols={len(items)}, ranges={len(occupied)}, gaps={len(gaps)}, overlaps={len(overlaps)}")
+
+    result = {"sections": sections}
+
+    if regions:
+        # 全セクションの使用範囲をまとめ直し、領域内の空きを求める
+        ranges = sorted((start, end, sect) for sect, info in sections.items() for start, end in info["occupied"])
+        occupied, _, _ = _sweep(ranges)
+
+        result["regions"] = {}
+        for name, (region_start, region_end) in regions.items():
+            used = 0
+            free_blocks = []
+            pos = region_start
+            for start, end in occupied:
+                if end <= region_start or start >= region_end:
+                    continue
+                start, end = max(start, region_start), min(end, region_end)
+                if start > pos:
+                    free_blocks.append((pos, start))
+                used += end - start
+                pos = end
+            if pos < region_end:
+                free_blocks.append((pos, region_end))
+
+            result["regions"][name] = {
+                "start": region_start,
+                "end": region_end,
+                "used": used,
+                "free": sum(end - start for start, end in free_blocks),
+                "free_blocks": heapq.nlargest(top_n, free_blocks, key=lambda g: g[1] - g[0]),
+            }
+            log.info(f"region={name}, used={used}, free_blocks={len(free_blocks)}")
+
+    return result
+
+
+if __name__ == '__main__':
+    # 引数の解析
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("file", help="解析するマップファイル",  type=str, nargs=1)
+    parser.add_argument("--align", help="アライメント", type=int, default=4)
+    args = parser.parse_args()
+
+    import mapfile
+
+    maps = []
+    mapfile.parse(args.file[0], callback=maps.append)
+
+    result = analyze(maps, align=args.align)
+    for sect, info in sorted(result["sections"].items(), key=lambda kv: kv[1]["start"]):
+        print(f"{sect:<20} 0x{info['start']:08x}-0x{info['end']:08x} used={info['used']} padding={info['padding']} free={info['free']} overlaps={len(info['overlaps'])}")
+        for start, end in info["free_blocks"]:
+            print(f"    free 0x{start:08x}-0x{end:08x} ({end - start})")
@@ -23,12 +23,15 @@ def encoding_detect(fname):
     return detector.result["encoding"]
 
 
-def create_database(map_fname, dla_fname, db_name="test.sqlite3"):
-    db = database.Database(db_name)
+def create_database(map_fname, dla_fname, db_name="test.sqlite3", aggregate=False, block=False, search_index=False, crossref_summary=False):
+    db = database.Database(db_name, aggregate=aggregate, search_index=search_index, crossref_summary=crossref_summary)
     db.open()
 
     mapfile.parse(map_fname, encoding=encoding_detect(map_fname), callback=db.cb_map)
-    dlafile.parse(dla_fname, encoding=encoding_detect(dla_fname), callback_symbol=db.cb_symbol, callback_crossref=db.cb_crossref)
+    if block:
+        dlafile.parse_blocks(dla_fname, encoding=encoding_detect(dla_fname), callback_symbols=db.cb_symbol_rows, callback_crossrefs=db.cb_crossref_rows)
+    else:
+        dlafile.parse(dla_fname, encoding=encoding_detect(dla_fname), callback_symbol=db.cb_symbol, callback_crossref=db.cb_crossref)
     
     db.close()
 